@@ -0,0 +1,59 @@
+#
+# Copyright (C) 2016 Jerome Kelleher <jerome.kelleher@well.ox.ac.uk>
+#
+# This file is part of msprime.
+#
+# msprime is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# msprime is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with msprime.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Cython version of Algorithm T from algorithms.py. This is an optional
+development module, and is not built by setup.py. To build it in place,
+run
+
+    cythonize -i _msprime_tree_gen.pyx
+"""
+cimport cython
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def iter_trees(
+        long long[::1] I, long long[::1] O, double[::1] left,
+        double[::1] right, int[::1] node, int[::1] children,
+        int[::1] children_offset, parent_out):
+    """
+    Sequentially visits all trees in the tree sequence defined by the
+    specified record arrays, with the index vectors I and O giving the
+    insertion and removal orders. The int32 array parent_out is updated
+    in place for each tree and yielded.
+    """
+    cdef int[::1] pi = parent_out
+    cdef Py_ssize_t M = left.shape[0]
+    cdef Py_ssize_t j = 0
+    cdef Py_ssize_t k = 0
+    cdef Py_ssize_t h, q
+    cdef double x
+    while j < M:
+        x = left[I[j]]
+        while right[O[k]] == x:
+            h = O[k]
+            for q in range(children_offset[h], children_offset[h + 1]):
+                pi[children[q]] = -1
+            k += 1
+        while j < M and left[I[j]] == x:
+            h = I[j]
+            for q in range(children_offset[h], children_offset[h + 1]):
+                pi[children[q]] = node[h]
+            j += 1
+        yield parent_out
@@ -4930,6 +4930,16 @@ static PyMethodDef msprime_methods[] = {
  * from the Python documentation still use this idiom.
  */
 
+/* We build with -fvisibility=hidden where we can, so we must export the
+ * init function explicitly; older versions of Python don't do this in
+ * PyMODINIT_FUNC.
+ */
+#if defined(__GNUC__) && __GNUC__ >= 4
+#define MSP_EXPORT __attribute__ ((visibility ("default")))
+#else
+#define MSP_EXPORT
+#endif
+
 #if PY_MAJOR_VERSION >= 3
 
 static struct PyModuleDef msprimemodule = {
@@ -4943,13 +4953,13 @@ static struct PyModuleDef msprimemodule = {
 
 #define INITERROR return NULL
 
-PyObject *
+MSP_EXPORT PyObject *
 PyInit__msprime(void)
 
 #else
 #define INITERROR return
 
-void
+MSP_EXPORT void
 init_msprime(void)
 #endif
 {
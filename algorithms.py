@@ -8,7 +8,10 @@ import sys
 import random
 import tempfile
 import argparse
+import bisect
+import collections
 import heapq
+import itertools
 import math
 
 import bintrees
@@ -21,6 +24,45 @@ import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot
 
+# Numba is an optional dependency used to compile the inner loops of the
+# tree generation algorithms. If it's not available we fall back on the
+# plain Python versions of the same functions.
+try:
+    import numba
+    _numba_imported = True
+except ImportError:
+    _numba_imported = False
+
+
+def jit(func):
+    """
+    Compiles the specified function to native code if numba is available;
+    otherwise returns the function unchanged.
+    """
+    if _numba_imported:
+        func = numba.njit(cache=True)(func)
+    return func
+
+
+def null_parent_array(n):
+    """
+    Returns a parent array of length n with all entries set to -1. This
+    is an int32 numpy array if numba is available; otherwise it is a
+    list, since indexing numpy arrays element by element in plain
+    Python is slower than indexing lists.
+    """
+    if _numba_imported:
+        return np.full(n, -1, dtype=np.int32)
+    return [-1 for j in range(n)]
+
+# The Cython version of Algorithm T is also optional, and must be built
+# separately using "cythonize -i _msprime_tree_gen.pyx".
+try:
+    import _msprime_tree_gen
+    _tree_gen_imported = True
+except ImportError:
+    _tree_gen_imported = False
+
 
 class FenwickTree(object):
     """
@@ -766,12 +808,10 @@ class Tree(object):
         self.__children = children
         self.__time = time
         self.__num_records = len(left)
-        self.__left_order = sorted(
-            range(self.__num_records), key=lambda j: (left[j], time[j]))
-        self.__right_order = sorted(
-            range(self.__num_records), key=lambda j: (right[j], -time[j]))
+        self.__left_order, self.__right_order = index_records(
+            left, right, time)
         self.__direction = -1
-        self.parent = [-1 for j in range(max(node) + 1)]
+        self.parent = null_parent_array(max(node) + 1)
         self.num_trees = len(set(left))
 
     def first(self):
@@ -834,15 +874,85 @@ class Tree(object):
         self.index -= 1
 
 
-def generate_trees(l, r, u, c, t):
+RecordArrays = collections.namedtuple(
+    "RecordArrays",
+    ["left", "right", "node", "children", "children_offset", "time"])
+
+
+record_dtype = np.dtype([
+    ("left", np.float64), ("right", np.float64), ("node", np.int32),
+    ("time", np.float64)])
+
+
+def load_records(l, r, u, c, t):
     """
-    Algorithm T. Sequentially visits all trees in the specified
-    tree sequence.
+    Converts the specified lists of coalescence record fields into a
+    RecordArrays instance, where each field is stored as a numpy array.
+    The children of record j are children[children_offset[j]:
+    children_offset[j + 1]], so that records may have any number of
+    children.
     """
-    # Calculate the index vectors
     M = len(l)
-    I = sorted(range(M), key=lambda j: (l[j], t[j]))
-    O = sorted(range(M), key=lambda j: (r[j], -t[j]))
+    # Read the scalar fields in a single pass over the records, and then
+    # take contiguous copies of the columns for the compiled kernels.
+    records = np.fromiter(zip(l, r, u, t), dtype=record_dtype, count=M)
+    children_offset = np.zeros(M + 1, dtype=np.int32)
+    children_offset[1:] = np.cumsum([len(children) for children in c])
+    children = np.fromiter(
+        itertools.chain(*c), dtype=np.int32, count=children_offset[-1])
+    return RecordArrays(
+        left=np.ascontiguousarray(records["left"]),
+        right=np.ascontiguousarray(records["right"]),
+        node=np.ascontiguousarray(records["node"]),
+        children=children,
+        children_offset=children_offset,
+        time=np.ascontiguousarray(records["time"]))
+
+
+def index_records(left, right, time):
+    """
+    Returns the index vectors I and O for the specified record fields,
+    such that I orders the records by (left, time) and O orders the
+    records by (right, -time).
+    """
+    time = np.asarray(time)
+    I = np.lexsort((time, left)).astype(np.int64)
+    O = np.lexsort((-time, right)).astype(np.int64)
+    return I, O
+
+
+@jit
+def advance_tree(
+        I, O, left, right, node, children, children_offset, pi, j, k):
+    """
+    Performs a single step of Algorithm T, updating the parent array pi
+    in place to reflect the next tree in the sequence. Returns the updated
+    values of the insertion and removal indexes j and k.
+    """
+    M = left.shape[0]
+    x = left[I[j]]
+    while right[O[k]] == x:
+        h = O[k]
+        for q in range(children_offset[h], children_offset[h + 1]):
+            pi[children[q]] = -1
+        k += 1
+    while j < M and left[I[j]] == x:
+        h = I[j]
+        for q in range(children_offset[h], children_offset[h + 1]):
+            pi[children[q]] = node[h]
+        j += 1
+    return j, k
+
+
+def generate_trees_python(l, r, u, c, t):
+    """
+    Version of Algorithm T used when neither numba nor the Cython module
+    is available. Indexing lists in plain Python is much faster than
+    indexing numpy arrays one element at a time, so this works directly
+    on the record lists, and the parent array pi is a list.
+    """
+    M = len(l)
+    I, O = [a.tolist() for a in index_records(l, r, t)]
     pi = [-1 for j in range(max(u) + 1)]
     j = 0
     k = 0
@@ -852,7 +962,7 @@ def generate_trees(l, r, u, c, t):
             h = O[k]
             for q in c[h]:
                 pi[q] = -1
-            k = k + 1
+            k += 1
         while j < M and l[I[j]] == x:
             h = I[j]
             for q in c[h]:
@@ -860,6 +970,35 @@ def generate_trees(l, r, u, c, t):
             j += 1
         yield pi
 
+
+def generate_trees(l, r, u, c, t):
+    """
+    Algorithm T. Sequentially visits all trees in the specified
+    tree sequence.
+    """
+    if not (_numba_imported or _tree_gen_imported):
+        for pi in generate_trees_python(l, r, u, c, t):
+            yield pi
+        return
+    s = load_records(l, r, u, c, t)
+    # Calculate the index vectors
+    M = len(s.left)
+    I, O = index_records(s.left, s.right, s.time)
+    pi = np.full(np.max(s.node) + 1, -1, dtype=np.int32)
+    if _tree_gen_imported:
+        for pi in _msprime_tree_gen.iter_trees(
+                I, O, s.left, s.right, s.node, s.children,
+                s.children_offset, pi):
+            yield pi
+    else:
+        j = 0
+        k = 0
+        while j < M:
+            j, k = advance_tree(
+                I, O, s.left, s.right, s.node, s.children,
+                s.children_offset, pi, j, k)
+            yield pi
+
 def reverse_generate_trees(l, r, u, c, t):
     """
     Reversed version of Algorithm T. Sequentially visits all trees
@@ -867,9 +1006,8 @@ def reverse_generate_trees(l, r, u, c, t):
     """
     # Calculate the index vectors
     M = len(l)
-    O = sorted(range(M), key=lambda j: (l[j], t[j]))
-    I = sorted(range(M), key=lambda j: (r[j], -t[j]))
-    pi = [-1 for j in range(max(u) + 1)]
+    O, I = index_records(l, r, t)
+    pi = null_parent_array(max(u) + 1)
     j = M - 1
     k = M - 1
     while j >= 0:
@@ -886,16 +1024,50 @@ def reverse_generate_trees(l, r, u, c, t):
             j -= 1
         yield pi
 
-def count_leaves(l, r, u, c, t, S):
+@jit
+def advance_leaf_counts(
+        I, O, left, right, node, children, children_offset, pi, beta, j, k):
     """
-    Algorithm L. Sequentially visits all trees in the specified
-    tree sequence and maintain a count of the leaf nodes in the
-    specified set for each node.
+    Performs a single step of Algorithm L, updating the parent array pi
+    and the leaf counts beta in place to reflect the next tree in the
+    sequence. Returns the updated values of the insertion and removal
+    indexes j and k.
+    """
+    M = left.shape[0]
+    x = left[I[j]]
+    while right[O[k]] == x:
+        h = O[k]
+        b = 0
+        for q in range(children_offset[h], children_offset[h + 1]):
+            pi[children[q]] = -1
+            b += beta[children[q]]
+        k += 1
+        v = node[h]
+        while v != -1:
+            beta[v] -= b
+            v = pi[v]
+    while j < M and left[I[j]] == x:
+        h = I[j]
+        b = 0
+        for q in range(children_offset[h], children_offset[h + 1]):
+            pi[children[q]] = node[h]
+            b += beta[children[q]]
+        j += 1
+        v = node[h]
+        while v != -1:
+            beta[v] += b
+            v = pi[v]
+    return j, k
+
+
+def count_leaves_python(l, r, u, c, t, S):
+    """
+    Version of Algorithm L used when numba is not available. As for
+    generate_trees_python, this works on lists, and the parent array pi
+    and leaf counts beta are lists.
     """
-    # Calculate the index vectors
     M = len(l)
-    I = sorted(range(M), key=lambda j: (l[j], t[j]))
-    O = sorted(range(M), key=lambda j: (r[j], -t[j]))
+    I, O = [a.tolist() for a in index_records(l, r, t)]
     pi = [-1 for j in range(max(u) + 1)]
     beta = [0 for j in range(max(u) + 1)]
     for j in S:
@@ -921,33 +1093,112 @@ def count_leaves(l, r, u, c, t, S):
             for q in c[h]:
                 pi[q] = u[h]
                 b += beta[q]
-            j = j + 1
+            j += 1
             v = u[h]
             while v != -1:
                 beta[v] += b
                 v = pi[v]
         yield pi, beta
 
-class LeafListNode(object):
-    def __init__(self, value, next=None):
-        self.value = value
-        self.next = next
 
-    def __str__(self):
-        next = -1 if self.next is None else self.next.value
-        return "{}->{}".format(self.value, next)
+def count_leaves(l, r, u, c, t, S):
+    """
+    Algorithm L. Sequentially visits all trees in the specified
+    tree sequence and maintain a count of the leaf nodes in the
+    specified set for each node.
+    """
+    if not _numba_imported:
+        for pi, beta in count_leaves_python(l, r, u, c, t, S):
+            yield pi, beta
+        return
+    s = load_records(l, r, u, c, t)
+    # Calculate the index vectors
+    M = len(s.left)
+    I, O = index_records(s.left, s.right, s.time)
+    pi = np.full(np.max(s.node) + 1, -1, dtype=np.int32)
+    beta = np.zeros(np.max(s.node) + 1, dtype=np.int32)
+    beta[list(S)] = 1
+    j = 0
+    k = 0
+    while j < M:
+        j, k = advance_leaf_counts(
+            I, O, s.left, s.right, s.node, s.children, s.children_offset,
+            pi, beta, j, k)
+        yield pi, beta
+
+
+def count_low_frequency_mutations(
+        l, r, u, c, t, S, positions, nodes, min_frequency):
+    """
+    Returns the number of mutations whose frequency among the leaves in
+    S is less than min_frequency, where mutation j occurs at positions[j]
+    above nodes[j]. The leaf counts are maintained using Algorithm L, and
+    the mutations within each tree are found by binary search on the
+    sorted positions, so that the frequency test for all mutations in a
+    tree is a single vectorised operation.
+    """
+    positions = np.asarray(positions, dtype=np.float64)
+    order = np.argsort(positions, kind="mergesort")
+    positions = positions[order]
+    nodes = np.asarray(nodes, dtype=np.int32)[order]
+    # Each tree returned by Algorithm L starts at a distinct left coordinate.
+    breakpoints = np.append(np.unique(l), max(r))
+    threshold = min_frequency * len(S)
+    num_mutations = 0
+    trees = count_leaves(l, r, u, c, t, S)
+    for j, (pi, beta) in enumerate(trees):
+        lo, hi = np.searchsorted(positions, breakpoints[j: j + 2])
+        counts = np.asarray(beta)[nodes[lo:hi]]
+        num_mutations += np.count_nonzero(counts < threshold)
+    return num_mutations
+
+
+def get_leaf_counts(pi, S):
+    """
+    Returns the number of leaves in the specified set below each node of
+    the tree defined by the parent array pi. This is computed directly
+    from the tree using vectorised operations, and is used to check the
+    counts maintained incrementally by Algorithm L.
+    """
+    pi = np.asarray(pi, dtype=np.int32)
+    N = len(pi)
+    nu = np.zeros(N, dtype=np.int64)
+    nu[list(S)] = 1
+    # Find the depth of each node by pointer jumping: at each step we know
+    # the distance from v to its ancestor a[v], and replace a[v] by a[a[v]].
+    # Roots are their own ancestors at distance 0, so this converges after
+    # a logarithmic number of passes.
+    is_child = pi != -1
+    a = np.where(is_child, pi, np.arange(N, dtype=np.int32))
+    depth = is_child.astype(np.int64)
+    while True:
+        next_a = a[a]
+        if np.array_equal(next_a, a):
+            break
+        depth += depth[a]
+        a = next_a
+    # Now propagate the counts upwards one level at a time, starting with
+    # the deepest nodes.
+    for d in range(np.max(depth), 0, -1):
+        level = np.nonzero(depth == d)[0]
+        np.add.at(nu, pi[level], nu[level])
+    return nu
+
 
 def propagate_leaf_loss(u, pi, xi, head, tail):
     # Invalidate the head and tail pointers above u that depend
     # on this node.
-    head[u] = None
-    tail[u] = None
+    head[u] = -1
+    tail[u] = -1
 
 
-def propagate_leaf_gain(u, pi, xi, head, tail):
+def propagate_leaf_gain(u, pi, xi, head, tail, next_):
     num_children = len(xi[u])
     for j in range(1, num_children):
-        tail[xi[u][j - 1]].next = head[xi[u][j]]
+        # A child with no leaves in S has tail -1, which numpy would
+        # silently take as the last element of next_.
+        assert tail[xi[u][j - 1]] != -1
+        next_[tail[xi[u][j - 1]]] = head[xi[u][j]]
     head[u] = head[xi[u][0]]
     tail[u] = tail[xi[u][-1]]
 
@@ -970,15 +1221,17 @@ def propagate_leaf_gain(u, pi, xi, head, tail):
         v = w
         w = pi[w]
 
-def post_propagate_leaf_gain(u, pi, xi, head, tail):
+def post_propagate_leaf_gain(u, pi, xi, head, tail, next_):
     v = u
     w = pi[v]
     while w != -1:
         j = xi[w].index(v)
         if j < len(xi[w]) - 1:
-            tail[v].next = head[xi[w][j + 1]]
+            assert tail[v] != -1
+            next_[tail[v]] = head[xi[w][j + 1]]
         if j > 0:
-            tail[xi[w][j - 1]].next = head[v]
+            assert tail[xi[w][j - 1]] != -1
+            next_[tail[xi[w][j - 1]]] = head[v]
         v = w
         w = pi[w]
 
@@ -987,20 +1240,22 @@ def leaf_sets(l, r, u, c, t, S):
     """
     Sequentially visits all trees in the specified
     tree sequence and maintain the leaf sets for all leaves in
-    specified set for each node.
+    specified set for each node. The leaf sets are stored as linked
+    lists threaded through the next_ array, so that the leaves below u
+    are head[u], next_[head[u]], ..., tail[u]. Every leaf of the trees
+    must be in S.
     """
     # Calculate the index vectors
     M = len(l)
-    I = sorted(range(M), key=lambda j: (l[j], t[j]))
-    O = sorted(range(M), key=lambda j: (r[j], -t[j]))
-    pi = [-1 for j in range(max(u) + 1)]
+    I, O = index_records(l, r, t)
+    pi = null_parent_array(max(u) + 1)
     xi = [[] for j in range(max(u) + 1)]
-    head = [None for j in range(max(u) + 1)]
-    tail = [None for j in range(max(u) + 1)]
+    head = np.full(max(u) + 1, -1, dtype=np.int32)
+    tail = np.full(max(u) + 1, -1, dtype=np.int32)
+    next_ = np.full(max(u) + 1, -1, dtype=np.int32)
     for j in S:
-        node = LeafListNode(j)
-        head[j] = node
-        tail[j] = node
+        head[j] = j
+        tail[j] = j
     j = 0
     k = 0
     while j < M:
@@ -1018,17 +1273,17 @@ def leaf_sets(l, r, u, c, t, S):
             for q in c[h]:
                 pi[q] = u[h]
             xi[u[h]] = c[h]
-            propagate_leaf_gain(u[h], pi, xi, head, tail)
+            propagate_leaf_gain(u[h], pi, xi, head, tail, next_)
             j += 1
         j = before
         while j < M and l[I[j]] == x:
             h = I[j]
-            post_propagate_leaf_gain(u[h], pi, xi, head, tail)
+            post_propagate_leaf_gain(u[h], pi, xi, head, tail, next_)
             j += 1
-        yield pi, xi, head, tail
+        yield pi, xi, head, tail, next_
 
 
-def check_consistency(n, pi, xi, head, tail):
+def check_consistency(n, pi, xi, head, tail, next_):
     """
     Checks the consistency of the specified parent list, child list
     and head and tail leaf list pointers.
@@ -1040,21 +1295,21 @@ def check_consistency(n, pi, xi, head, tail):
     assert set(all_leaves) == set(range(n))
     for u in nodes(root, xi):
         node_leaves = list(leaves(u, xi))
-        if node_leaves[0] != head[u].value:
-            print("HERROR: head incorrect:", head[u].value)
-        if node_leaves[-1] != tail[u].value:
-            print("TERROR: tail incorrect:", tail[u].value)
+        if node_leaves[0] != head[u]:
+            print("HERROR: head incorrect:", head[u])
+        if node_leaves[-1] != tail[u]:
+            print("TERROR: tail incorrect:", tail[u])
         list_leaves = []
         x = head[u]
         while True:
-            if x.value in list_leaves:
-                print("ERROR!!!", x.value, "already in leaf list at index",
-                        list_leaves.index(x.value), "len = ", len(list_leaves))
+            if x in list_leaves:
+                print("ERROR!!!", x, "already in leaf list at index",
+                        list_leaves.index(x), "len = ", len(list_leaves))
                 break
-            list_leaves.append(x.value)
+            list_leaves.append(x)
             if x == tail[u]:
                 break
-            x = x.next
+            x = next_[x]
         if list_leaves != node_leaves:
             print("ERROR")
             print(list_leaves)
@@ -1071,10 +1326,10 @@ def print_tree(u, xi, head, tail, depth):
     leaf_list = []
     # x = head[u]
     # while True:
-    #     leaf_list.append(x.value)
+    #     leaf_list.append(x)
     #     if x == tail[u]:
     #         break
-    #     x = x.next
+    #     x = next_[x]
     print("{}[{}:{}]\thead = {}; tail = {}\t{}".format(
         indent, u, len(xi[u]), head[u], tail[u], leaf_list))
     for v in xi[u]:
@@ -1123,14 +1378,14 @@ def process_trees(records_file):
     print("Trees:")
     forward = []
     for pi in generate_trees(l, r, u, c, t):
-        forward.append(list(pi))
+        forward.append(np.array(pi))
     T = len(forward)
     print("START")
     tree = Tree(l, r, u, c, t)
     tree.first()
     for j in range(T):
         assert tree.index == j
-        assert tree.parent == forward[j]
+        assert np.array_equal(tree.parent, forward[j])
         if j < T - 1:
             tree.next()
 
@@ -1139,41 +1394,60 @@ def process_trees(records_file):
     for j in range(T):
         print(j, tree.index, T)
         assert tree.index == T - j - 1
-        assert tree.parent == forward[T - j - 1]
+        assert np.array_equal(tree.parent, forward[T - j - 1])
         if j < T - 1:
             tree.prev()
 
     tree = Tree(l, r, u, c, t)
     tree.first()
     print("first done")
-    assert tree.parent == forward[0]
+    assert np.array_equal(tree.parent, forward[0])
     assert tree.index == 0
     for _ in range(1):
         for _ in range(T // 2):
             tree.next()
             print("\t", tree.index)
-            assert tree.parent == forward[tree.index]
+            assert np.array_equal(tree.parent, forward[tree.index])
         for j in range(10):
             print("Reverse")
             for _ in range(T // 3):
                 tree.prev()
                 print("\t", tree.index)
-                assert tree.parent == forward[tree.index]
+                assert np.array_equal(tree.parent, forward[tree.index])
             print("Forward")
             for _ in range(T // 3):
                 tree.next()
                 print("\t", tree.index)
-                assert tree.parent == forward[tree.index]
-
-
-    # n = min(u)
-    # S = set(range(n))
-    # # print("Counts:")
-    # # for pi, beta in count_leaves(l, r, u, c, t, S):
-    # #     print("\t", beta)
+                assert np.array_equal(tree.parent, forward[tree.index])
+
+
+    n = min(u)
+    S = set(range(n))
+    for pi, beta in count_leaves(l, r, u, c, t, S):
+        assert np.array_equal(beta, get_leaf_counts(pi, S))
+    # Check the columnar mutation count against a direct count of the
+    # leaves below each of a random set of mutations.
+    rng = np.random.RandomState(5)
+    num_mutations = 100
+    positions = rng.uniform(0, max(r), num_mutations)
+    mutation_nodes = rng.randint(0, max(u) + 1, num_mutations)
+    breakpoints = sorted(set(l))
+    min_frequency = 0.5
+    expected = 0
+    for x, v in zip(positions, mutation_nodes):
+        pi = forward[bisect.bisect_right(breakpoints, x) - 1]
+        count = 0
+        for w in S:
+            while w != -1 and w != v:
+                w = pi[w]
+            count += w == v
+        if count < min_frequency * len(S):
+            expected += 1
+    assert expected == count_low_frequency_mutations(
+        l, r, u, c, t, S, positions, mutation_nodes, min_frequency)
     # print("Counts:")
-    # for pi, xi, head, tail in leaf_sets(l, r, u, c, t, S):
-    #     check_consistency(n, pi, xi, head, tail)
+    # for pi, xi, head, tail, next_ in leaf_sets(l, r, u, c, t, S):
+    #     check_consistency(n, pi, xi, head, tail, next_)
     #     print(pi)
     #     print(xi)
 
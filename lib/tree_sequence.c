@@ -37,7 +37,7 @@ typedef struct {
 } index_sort_t;
 
 static int
-cmp_uint32_t(const void *a, const void *b) {
+cmp_node(const void *a, const void *b) {
     const uint32_t *ia = (const uint32_t *) a;
     const uint32_t *ib = (const uint32_t *) b;
     return (*ia > *ib) - (*ia < *ib);
@@ -1649,7 +1649,7 @@ tree_sequence_compress_nodes(tree_sequence_t *self, uint32_t *samples, size_t nu
         for (c = 0; c < cr->num_children; c++) {
             cr->children[c] = node_map[cr->children[c]];
         }
-        qsort(cr->children, cr->num_children, sizeof(uint32_t), cmp_uint32_t);
+        qsort(cr->children, cr->num_children, sizeof(uint32_t), cmp_node);
     }
     for (j = 0; j < num_mutations; j++) {
         mutations[j].node = node_map[mutations[j].node];
@@ -2008,7 +2008,7 @@ tree_sequence_get_subset(tree_sequence_t *self, uint32_t *samples,
      */
     for (j = 0; j < num_subset_records; j++) {
         cr = &subset_records[j];
-        qsort(cr->children, cr->num_children, sizeof(uint32_t), cmp_uint32_t);
+        qsort(cr->children, cr->num_children, sizeof(uint32_t), cmp_node);
     }
     ret = squash_records(subset_records, num_subset_records, &num_squashed_records);
     if (ret != 0) {
@@ -24,10 +24,26 @@ from __future__ import print_function
 
 import argparse
 import hashlib
+import json
+import multiprocessing
 import os
 import random
 import signal
+import socket
 import sys
+import traceback
+
+try:
+    # Python 2: we need a StringIO that accepts str instances.
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import socketserver
+except ImportError:
+    # Python 2
+    import SocketServer as socketserver
 
 import msprime
 
@@ -57,6 +73,11 @@ Jerome Kelleher, Alison M Etheridge and Gilean McVean (2016), "Efficient
 Coalescent Simulation and Genealogical Analysis for Large Sample Sizes",
 PLoS Comput Biol 12(5): e1004842. doi: 10.1371/journal.pcbi.1004842
 """
+mspms_daemon_text = """
+To avoid the start up cost of mspms for many small simulations, run
+"mspms --daemon --socket PATH" and send command lines to it using
+mspms-client; see "mspms --daemon -h" for details.
+"""
 
 
 def positive_int(value):
@@ -90,13 +111,18 @@ def add_precision_argument(parser):
         help="The number of decimal places to print in records")
 
 
+# The number of random bits in each of the generated command line seeds.
+_SEED_BITS = 31
+
+
 def generate_seeds():
     """
     Generate seeds to seed the RNG and output on the command line.
     """
-    # Pull three numbers from the SystemRandom generator
+    # Pull three numbers from the SystemRandom generator. The command
+    # line seeds must be positive, so we map the (improbable) zero to 1.
     rng = random.SystemRandom()
-    return [rng.randint(0, 2**31) for _ in range(3)]
+    return [rng.getrandbits(_SEED_BITS) or 1 for _ in range(3)]
 
 
 def get_single_seed(seeds):
@@ -105,14 +131,33 @@ def get_single_seed(seeds):
     that can be used to seed the python random number generator.
     """
     assert len(seeds) == 3
-    m = hashlib.md5()
-    for s in seeds:
-        # Colon separate the values to ensure that we don't have
-        # collisions in situations like 1:23:45, 12:3:45.
-        m.update("{}:".format(s).encode())
+    # Colon separate the values to ensure that we don't have
+    # collisions in situations like 1:23:45, 12:3:45.
+    m = hashlib.md5("{}:{}:{}:".format(*seeds).encode())
     # Now take the integer value of this modulo 2^32, as this is
-    # the largest seed value we'll accept.
-    return int(m.hexdigest(), 16) % (2**32)
+    # the largest seed value we'll accept. This is given by the last
+    # 8 hex digits, so we don't need to convert the full digest.
+    return int(m.hexdigest()[-8:], 16)
+
+
+# The number of newick trees we write to the output at a time.
+_NEWICK_CHUNK_SIZE = 4096
+
+# The number of characters mspms-client reads from the daemon at a time.
+_CLIENT_CHUNK_SIZE = 65536
+
+# The SimulationRunner used by each worker process when running
+# replicates in parallel.
+_worker_runner = None
+
+
+def _initialise_worker(runner_args):
+    global _worker_runner
+    _worker_runner = SimulationRunner(**runner_args)
+
+
+def _run_replicate_worker(seed):
+    return _worker_runner.run_seeded_replicate(seed)
 
 
 class SimulationRunner(object):
@@ -124,39 +169,68 @@ class SimulationRunner(object):
             num_replicates=1, migration_matrix=None,
             population_configurations=None, demographic_events=None,
             scaled_mutation_rate=0, print_trees=False,
-            precision=3, random_seeds=None):
+            precision=3, random_seeds=None, num_threads=1):
         self._sample_size = sample_size
         self._num_loci = num_loci
         self._num_replicates = num_replicates
+        self._migration_matrix = migration_matrix
+        self._population_configurations = population_configurations
+        self._demographic_events = demographic_events
         # We use unscaled per-generation rates. By setting Ne = 1 we
         # don't need to rescale, but we still need to divide by 4 to
         # cancel the factor introduced when calculated the scaled rates.
         self._recombination_rate = scaled_recombination_rate / 4
         self._mutation_rate = scaled_mutation_rate / 4
-        # For strict ms-compability we want to have m non-recombining loci
-        recomb_map = msprime.RecombinationMap.uniform_map(
-            num_loci, self._recombination_rate, num_loci)
-        # If we have specified any population_configurations we don't want
-        # to give the overall sample size.
-        sample_size = self._sample_size
-        if population_configurations is not None:
-            sample_size = None
-        self._simulator = msprime.simulator_factory(
-            sample_size=sample_size,
-            recombination_map=recomb_map,
-            population_configurations=population_configurations,
-            migration_matrix=migration_matrix,
-            demographic_events=demographic_events)
         self._precision = precision
+        # The format for mutation positions, with the precision filled in.
+        self._position_format = "{{0:.{0}f}}".format(precision)
         self._print_trees = print_trees
+        self._num_threads = num_threads
         # sort out the random seeds
         ms_seeds = random_seeds
         if random_seeds is None:
             ms_seeds = generate_seeds()
-        seed = get_single_seed(ms_seeds)
-        self._random_generator = msprime.RandomGenerator(seed)
+        self._seed = get_single_seed(ms_seeds)
+        self._random_generator = msprime.RandomGenerator(self._seed)
         self._ms_random_seeds = ms_seeds
-        self._simulator.set_random_generator(self._random_generator)
+        # For strict ms-compability we want to have m non-recombining loci.
+        # The map is immutable, so we share it between all the simulators
+        # we create.
+        self._recomb_map = msprime.RecombinationMap.uniform_map(
+            self._num_loci, self._recombination_rate, self._num_loci)
+        self._simulator = self._create_simulator(self._random_generator)
+        # Worker processes create their own copies of this runner from
+        # these arguments when we run replicates in parallel.
+        self._worker_args = {
+            "sample_size": sample_size,
+            "num_loci": num_loci,
+            "scaled_recombination_rate": scaled_recombination_rate,
+            "migration_matrix": migration_matrix,
+            "population_configurations": population_configurations,
+            "demographic_events": demographic_events,
+            "scaled_mutation_rate": scaled_mutation_rate,
+            "print_trees": print_trees,
+            "precision": precision,
+            "random_seeds": ms_seeds,
+        }
+
+    def _create_simulator(self, random_generator):
+        """
+        Returns a new simulator for the parameters of this runner using
+        the specified random generator.
+        """
+        # If we have specified any population_configurations we don't want
+        # to give the overall sample size.
+        sample_size = self._sample_size
+        if self._population_configurations is not None:
+            sample_size = None
+        return msprime.simulator_factory(
+            sample_size=sample_size,
+            random_generator=random_generator,
+            recombination_map=self._recomb_map,
+            population_configurations=self._population_configurations,
+            migration_matrix=self._migration_matrix,
+            demographic_events=self._demographic_events)
 
     def get_num_replicates(self):
         """
@@ -177,54 +251,114 @@ class SimulationRunner(object):
         """
         return self._mutation_rate
 
-    def run(self, output):
+    def run(self, output, command_line=None):
         """
         Runs the simulations and writes the output to the specified
-        file handle.
+        file handle. The command line printed at the start of the output
+        is sys.argv, unless the command_line list is specified.
         """
+        if command_line is None:
+            command_line = sys.argv
         # The first line of ms's output is the command line.
-        print(" ".join(sys.argv), file=output)
+        print(" ".join(command_line), file=output)
         print(" ".join(str(s) for s in self._ms_random_seeds), file=output)
-        for j in range(self._num_replicates):
-            self._simulator.run()
-            tree_sequence = self._simulator.get_tree_sequence()
-            breakpoints = self._simulator.get_breakpoints()
-            print(file=output)
-            print("//", file=output)
-            if self._print_trees:
-                iterator = tree_sequence.newick_trees(
-                    self._precision, breakpoints, 1)
-                if self._num_loci == 1:
-                    for l, ns in iterator:
-                        print(ns, file=output)
-                else:
-                    for l, ns in iterator:
-                        # Print these seperately to avoid the cost of creating
-                        # another string.
-                        print("[{0}]".format(int(l)), end="", file=output)
-                        print(ns, file=output)
-            if self._mutation_rate > 0:
-                tree_sequence.generate_mutations(
-                    self._mutation_rate, self._random_generator)
-                hg = msprime.HaplotypeGenerator(tree_sequence)
-                s = tree_sequence.get_num_mutations()
-                print("segsites:", s, file=output)
-                if s != 0:
-                    print("positions: ", end="", file=output)
-                    positions = [
-                        mutation.position / self._num_loci for mutation in
-                        tree_sequence.mutations()]
-                    positions.sort()
-                    for position in positions:
-                        print(
-                            "{0:.{1}f}".format(position, self._precision),
-                            end=" ", file=output)
-                    print(file=output)
-                    for h in hg.haplotypes():
-                        print(h, file=output)
+        if self._num_threads == 1:
+            # We collect the output for each replicate and write it in one
+            # call, unless we're writing to a terminal where the user will
+            # want to see the output as it is produced.
+            buffered = not (hasattr(output, "isatty") and output.isatty())
+            for j in range(self._num_replicates):
+                if buffered:
+                    replicate_output = StringIO()
+                    self._run_replicate(
+                        replicate_output, self._simulator,
+                        self._random_generator)
+                    output.write(replicate_output.getvalue())
                 else:
-                    print(file=output)
-            self._simulator.reset()
+                    self._run_replicate(
+                        output, self._simulator, self._random_generator)
+                self._simulator.reset()
+        else:
+            self._run_parallel(output)
+
+    def _run_parallel(self, output):
+        """
+        Runs the replicates in a pool of worker processes, writing the
+        output for each replicate in order as it becomes available.
+        """
+        # Each replicate gets its own random generator, seeded from a
+        # sequence determined by the command line seeds. The output is
+        # therefore the same for any number of worker processes > 1.
+        rng = random.Random(self._seed)
+        seeds = [
+            rng.randint(1, 2**32 - 1) for _ in range(self._num_replicates)]
+        pool = multiprocessing.Pool(
+            self._num_threads, initializer=_initialise_worker,
+            initargs=(self._worker_args,))
+        try:
+            for replicate in pool.imap(_run_replicate_worker, seeds):
+                output.write(replicate)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def run_seeded_replicate(self, seed):
+        """
+        Runs a single replicate using a new random generator with the
+        specified seed, and returns the output as a string.
+        """
+        random_generator = msprime.RandomGenerator(seed)
+        simulator = self._create_simulator(random_generator)
+        output = StringIO()
+        self._run_replicate(output, simulator, random_generator)
+        return output.getvalue()
+
+    def _run_replicate(self, output, simulator, random_generator):
+        """
+        Runs a single replicate using the specified simulator and writes
+        the output to the specified file handle.
+        """
+        simulator.run()
+        tree_sequence = simulator.get_tree_sequence()
+        breakpoints = simulator.get_breakpoints()
+        output.write("\n//\n")
+        if self._print_trees:
+            iterator = tree_sequence.newick_trees(
+                self._precision, breakpoints, 1)
+            # Collect the trees into chunks and write each chunk in one
+            # call, as there can be a very large number of trees.
+            lines = []
+            if self._num_loci == 1:
+                for l, ns in iterator:
+                    lines.append(ns + "\n")
+                    if len(lines) == _NEWICK_CHUNK_SIZE:
+                        output.writelines(lines)
+                        lines = []
+            else:
+                for l, ns in iterator:
+                    lines.append("[{0}]{1}\n".format(int(l), ns))
+                    if len(lines) == _NEWICK_CHUNK_SIZE:
+                        output.writelines(lines)
+                        lines = []
+            output.writelines(lines)
+        if self._mutation_rate > 0:
+            tree_sequence.generate_mutations(
+                self._mutation_rate, random_generator)
+            hg = msprime.HaplotypeGenerator(tree_sequence)
+            s = tree_sequence.get_num_mutations()
+            output.write("segsites: {0}\n".format(s))
+            if s != 0:
+                positions = [
+                    mutation.position / self._num_loci for mutation in
+                    tree_sequence.mutations()]
+                positions.sort()
+                # ms writes a trailing space after the last position.
+                position_format = self._position_format.format
+                output.write("positions: {0} \n".format(" ".join(
+                    position_format(position) for position in positions)))
+                output.writelines(h + "\n" for h in hg.haplotypes())
+            else:
+                output.write("\n")
 
 
 def convert_int(value, parser):
@@ -535,7 +669,8 @@ def create_simulation_runner(parser, arg_list):
         scaled_mutation_rate=mu,
         precision=args.precision,
         print_trees=args.trees,
-        random_seeds=args.random_seeds)
+        random_seeds=args.random_seeds,
+        num_threads=args.num_threads)
     return runner
 
 
@@ -713,11 +848,18 @@ def get_mspms_parser(error_handler=None):
     group.add_argument(
         "--precision", "-p", type=positive_int, default=3,
         help="Number of values after decimal place to print")
+    group.add_argument(
+        "--num-threads", "-P", type=positive_int, default=1,
+        help=(
+            "Run replicates in parallel using the specified number of "
+            "worker processes. Replicates are seeded independently when "
+            "this is greater than 1, so the output differs from a "
+            "sequential run with the same seeds."))
 
     # now for the parser that gets called first
     init_parser = argparse.ArgumentParser(
         description=mscompat_description,
-        epilog=msprime_citation_text,
+        epilog=mspms_daemon_text + msprime_citation_text,
         add_help=False,
         parents=[parser])
     init_parser.convert_arg_line_to_args = convert_arg_line_to_args
@@ -747,9 +889,195 @@ def get_mspms_runner(arg_list):
 
 
 def mspms_main(arg_list=None):
+    if arg_list is None:
+        arg_list = sys.argv[1:]
+    # The --daemon flag may appear anywhere in the arguments, and the
+    # rest of them are then passed to the daemon.
+    if "--daemon" in arg_list:
+        mspms_daemon_main([arg for arg in arg_list if arg != "--daemon"])
+    else:
+        set_sigpipe_handler()
+        sr = get_mspms_runner(arg_list)
+        sr.run(sys.stdout)
+
+
+#######################################################
+# mspms daemon mode
+#######################################################
+
+# A client request is a single line containing a JSON object with the
+# keys "command_line" (the list of strings to print as the first line of
+# the output) and "args" (the list of arguments to mspms). The reply
+# starts with a line containing the exit status that mspms would have
+# given. The rest of the reply is the output of the simulations if this
+# is zero, and otherwise the error message.
+
+def _create_daemon_runner(arg_list):
+    """
+    Returns the tuple (runner, status, message) for the specified list of
+    mspms arguments. If argparse exits while parsing the arguments
+    (because of an error, or for the help and version options), runner
+    is None and status and message are the exit status and the text
+    that mspms would have written.
+    """
+    # The daemon handles one request at a time, so it's safe to swap out
+    # the standard streams to collect what argparse writes.
+    buff = StringIO()
+    stdout = sys.stdout
+    stderr = sys.stderr
+    sys.stdout = buff
+    sys.stderr = buff
+    try:
+        runner = get_mspms_runner(arg_list)
+        ret = runner, 0, ""
+    except SystemExit as se:
+        status = se.code
+        if status is None:
+            status = 0
+        ret = None, status, buff.getvalue()
+    finally:
+        sys.stdout = stdout
+        sys.stderr = stderr
+    return ret
+
+
+class MspmsRequestHandler(socketserver.BaseRequestHandler):
+    """
+    Handles a single mspms client request.
+    """
+    def handle(self):
+        reader = self.request.makefile("r")
+        writer = self.request.makefile("w")
+        try:
+            message = json.loads(reader.readline())
+            runner, status, text = _create_daemon_runner(message["args"])
+            if runner is not None:
+                # We can't send the status until we know whether the
+                # simulations succeed, so we must buffer the output.
+                output = StringIO()
+                try:
+                    runner.run(output, command_line=message["command_line"])
+                    text = output.getvalue()
+                except Exception:
+                    # mspms would exit with this traceback.
+                    status = 1
+                    text = traceback.format_exc()
+            print(status, file=writer)
+            writer.write(text)
+            writer.close()
+        except socket.error:
+            # The client has gone away, so there's nobody to report to.
+            pass
+        finally:
+            reader.close()
+
+
+def create_mspms_daemon(socket_path):
+    """
+    Returns a server listening on the Unix domain socket at the specified
+    path, which runs mspms command lines sent by mspms-client.
+    """
+    return socketserver.UnixStreamServer(socket_path, MspmsRequestHandler)
+
+
+def get_mspms_daemon_parser():
+    parser = argparse.ArgumentParser(
+        prog="mspms --daemon",
+        description=(
+            "Run a long-lived mspms process that runs the command lines "
+            "sent to it by mspms-client, avoiding the start up cost of "
+            "mspms for each invocation."))
+    parser.add_argument(
+        "--socket", "-s", required=True,
+        help="The path of the Unix domain socket to listen on")
+    return parser
+
+
+def _exit_on_sigterm(signum, frame):
+    sys.exit(0)
+
+
+def mspms_daemon_main(arg_list=None):
+    parser = get_mspms_daemon_parser()
+    args = parser.parse_args(arg_list)
+    if not hasattr(socketserver, "UnixStreamServer"):
+        parser.error("Unix domain sockets are not supported on this platform")
+    if os.path.exists(args.socket):
+        parser.error("{} already exists".format(args.socket))
+    server = create_mspms_daemon(args.socket)
+    # Make sure that we remove the socket when we're killed.
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+def run_mspms_client(socket_path, command_line, arg_list, output, errors):
+    """
+    Sends the specified mspms arguments to the daemon listening on the
+    specified socket, and writes the reply to output, or to errors if
+    mspms reports an error. Returns the exit status reported by mspms.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        message = {"command_line": command_line, "args": arg_list}
+        sock.sendall((json.dumps(message) + "\n").encode())
+        reader = sock.makefile("r")
+        try:
+            line = reader.readline()
+            if line == "":
+                print("The mspms daemon closed the connection", file=errors)
+                return 1
+            status = int(line)
+            out = output if status == 0 else errors
+            chunk = reader.read(_CLIENT_CHUNK_SIZE)
+            while len(chunk) > 0:
+                out.write(chunk)
+                chunk = reader.read(_CLIENT_CHUNK_SIZE)
+        finally:
+            reader.close()
+    finally:
+        sock.close()
+    return status
+
+
+def get_mspms_client_parser():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Run mspms using a daemon started with "
+            "'mspms --daemon --socket PATH'. The output is the same as "
+            "running mspms with the specified arguments. Files given "
+            "with -f are read relative to the working directory of "
+            "the daemon."))
+    parser.add_argument(
+        "--socket", "-s", required=True,
+        help="The path of the Unix domain socket the daemon listens on")
+    parser.add_argument(
+        "mspms_args", nargs=argparse.REMAINDER, metavar="args",
+        help="The arguments to mspms")
+    return parser
+
+
+def mspms_client_main(arg_list=None):
     set_sigpipe_handler()
-    sr = get_mspms_runner(arg_list)
-    sr.run(sys.stdout)
+    if arg_list is None:
+        arg_list = sys.argv[1:]
+    parser = get_mspms_client_parser()
+    args = parser.parse_args(arg_list)
+    try:
+        status = run_mspms_client(
+            args.socket, ["mspms"] + args.mspms_args, args.mspms_args,
+            sys.stdout, sys.stderr)
+    except socket.error as se:
+        parser.error(
+            "Error communicating with the mspms daemon: {}".format(se))
+    if status != 0:
+        sys.exit(status)
 
 
 #######################################################
@@ -19,16 +19,516 @@
 from __future__ import division
 from __future__ import print_function
 
+import copy
+import functools
+import glob
+import hashlib
+import inspect
+import multiprocessing
+import os
+import platform
+import re
+import shutil
 import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
 
 # First, we try to use setuptools. If it's not available locally,
 # we fall back on ez_setup.
 try:
     from setuptools import setup, Extension
+    from setuptools.command.build_ext import build_ext
 except ImportError:
     from ez_setup import use_setuptools
     use_setuptools()
     from setuptools import setup, Extension
+    from setuptools.command.build_ext import build_ext
+
+from distutils import log
+from distutils.ccompiler import CCompiler
+from distutils.dep_util import newer_group
+from distutils.dir_util import remove_tree
+from distutils.spawn import find_executable
+
+
+def get_num_build_jobs():
+    """
+    Returns the number of compiler processes to run at once when building
+    the extension module. This is the value of the MSPRIME_NCPU
+    environment variable if it is set, then that of MAX_JOBS (which is
+    also used by other build systems to limit memory use), and otherwise
+    the number of CPUs that we are allowed to run on. Values that are
+    not integers are ignored with a warning.
+    """
+    for var in ["MSPRIME_NCPU", "MAX_JOBS"]:
+        if os.environ.get(var):
+            try:
+                return int(os.environ[var])
+            except ValueError:
+                log.warn(
+                    "Ignoring {}={!r}: not an integer".format(
+                        var, os.environ[var]))
+    try:
+        # This respects any CPU affinity limits (e.g. from taskset).
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available in Python 2 or on OS X.
+        try:
+            return multiprocessing.cpu_count()
+        except NotImplementedError:
+            return 1
+
+
+def uses_generic_compile(compiler):
+    """
+    Returns True if the specified compiler uses the default implementation
+    of CCompiler.compile, which compiles each source by calling _compile.
+    """
+    # CCompiler is an old-style class in Python 2, so we can't use __mro__.
+    for cls in inspect.getmro(compiler.__class__):
+        if "compile" in vars(cls):
+            return cls is CCompiler
+    return False
+
+
+_local_include_pattern = re.compile(r'^\s*#\s*include\s+"([^"]+)"', re.M)
+
+
+def find_local_headers(path, include_dirs, headers=None):
+    """
+    Returns the set of headers that the specified C file includes, directly
+    or indirectly, using #include "...". Headers are looked for in the
+    directory of the including file and then in include_dirs; any that
+    we can't find (e.g. system headers) are ignored.
+    """
+    if headers is None:
+        headers = set()
+    with open(path) as f:
+        names = _local_include_pattern.findall(f.read())
+    for name in names:
+        search_dirs = [os.path.dirname(path)] + list(include_dirs)
+        for directory in search_dirs:
+            header = os.path.normpath(os.path.join(directory, name))
+            if os.path.exists(header):
+                if header not in headers:
+                    headers.add(header)
+                    find_local_headers(header, include_dirs, headers)
+                break
+    return headers
+
+
+# The headers that define the versions of GSL and HDF5.
+library_version_headers = [
+    os.path.join("gsl", "gsl_version.h"), "H5pubconf.h",
+    os.path.join("hdf5", "serial", "H5pubconf.h")]
+
+
+def find_library_version_headers(include_dirs):
+    """
+    Returns the paths of the GSL and HDF5 version headers that the
+    compiler will find, looking in the specified include directories and
+    then in the default system ones.
+    """
+    search_dirs = list(include_dirs) + ["/usr/local/include", "/usr/include"]
+    paths = []
+    for name in library_version_headers:
+        for directory in search_dirs:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                paths.append(path)
+                break
+    return paths
+
+
+def compile_sources(
+        compiler, num_jobs, sources, output_dir=None, macros=None,
+        include_dirs=None, debug=0, extra_preargs=None, extra_postargs=None,
+        depends=None, pch_header=None, pch_sources=()):
+    """
+    A version of CCompiler.compile that runs up to num_jobs compiler
+    processes at once. Each source is compiled independently by
+    compiler._compile, so we can run these calls from a thread pool.
+    Unless the compiler's force flag is set, we skip objects that are up
+    to date. An object is up to date if it is newer than its source, the
+    local headers and C files that the source includes, and any depends
+    that aren't C files or headers, and if it was compiled with the same
+    command as we would use now. We keep the command used for each object
+    in a .cmd file next to it.
+    If pch_header is specified, we precompile it with the same options
+    as the sources (GCC only) and include it first in the sources listed
+    in pch_sources.
+    """
+    macros, objects, extra_postargs, pp_opts, build = compiler._setup_compile(
+        output_dir, macros, include_dirs, sources, depends, extra_postargs)
+    cc_args = compiler._get_cc_args(pp_opts, debug, extra_preargs)
+    all_include_dirs = list(include_dirs or []) + compiler.include_dirs
+    # We find the C files and headers that each source includes itself,
+    # so that changing one doesn't recompile every object.
+    other_depends = [
+        dep for dep in depends or []
+        if os.path.splitext(dep)[1] not in (".c", ".h")]
+
+    def get_cc_args(src):
+        if src in pch_sources:
+            return cc_args + ["-Winvalid-pch", "-include", pch_header]
+        return cc_args
+
+    def get_command(obj):
+        src, ext = build[obj]
+        return repr(
+            list(getattr(compiler, "compiler_so", [])) + get_cc_args(src) +
+            [src, "-o", obj] + extra_postargs)
+
+    def compile_object(obj):
+        src, ext = build[obj]
+        command_file = obj + ".cmd"
+        if os.path.exists(command_file):
+            os.remove(command_file)
+        compiler._compile(
+            obj, src, ext, get_cc_args(src), extra_postargs, pp_opts)
+        with open(command_file, "w") as f:
+            f.write(get_command(obj))
+
+    def is_up_to_date(obj):
+        src, ext = build[obj]
+        inputs = [src] + other_depends
+        inputs.extend(find_local_headers(src, all_include_dirs))
+        if newer_group(inputs, obj):
+            return False
+        try:
+            with open(obj + ".cmd") as f:
+                return f.read() == get_command(obj)
+        except IOError:
+            return False
+
+    pending = [obj for obj in objects if obj in build]
+    if not compiler.force:
+        up_to_date = [obj for obj in pending if is_up_to_date(obj)]
+        for obj in up_to_date:
+            log.debug("skipping %s (up-to-date)", obj)
+        pending = [obj for obj in pending if obj not in up_to_date]
+    if any(build[obj][0] in pch_sources for obj in pending):
+        # This is cheap next to compiling the sources, so we always do it
+        # rather than working out whether the existing one is still valid.
+        compiler.spawn(
+            compiler.compiler_so + cc_args +
+            ["-x", "c-header", pch_header, "-o", pch_header + ".gch"] +
+            extra_postargs)
+    num_jobs = min(num_jobs, len(pending))
+    if num_jobs > 1:
+        pool = ThreadPool(num_jobs)
+        try:
+            pool.map(compile_object, pending)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for obj in pending:
+            compile_object(obj)
+    return objects
+
+
+# The simulations used to collect profile data for PGO builds.
+pgo_training_script = """
+import _msprime
+for seed in range(1, 21):
+    rng = _msprime.RandomGenerator(seed)
+    sim = _msprime.Simulator(
+        samples=[(0, 0)] * 100, random_generator=rng, num_loci=1000,
+        scaled_recombination_rate=0.01, max_memory=1024**3)
+    sim.run()
+    recomb_map = _msprime.RecombinationMap(1000, [0, 1000], [0.01, 0])
+    tree_sequence = _msprime.TreeSequence()
+    tree_sequence.create(sim, recomb_map, 0.25)
+    tree_sequence.generate_mutations(1e-3, rng)
+"""
+
+
+# The headers that we precompile for MSPRIME_PCH=1 builds. The library
+# sources include these again, so they must all have include guards.
+pch_includes = [
+    "<assert.h>", "<float.h>", "<limits.h>", "<math.h>", "<stdio.h>",
+    "<stdlib.h>", "<string.h>", "<hdf5.h>", "<gsl/gsl_math.h>",
+    "<gsl/gsl_randist.h>", '"msprime.h"']
+
+
+class BuildExt(build_ext):
+    """
+    Builds the extension module, compiling its sources in parallel.
+    The number of compiler processes is given by the build_ext parallel
+    option (-j), which defaults to the value of get_num_build_jobs().
+    If ccache is installed, the compiler is run through it unless
+    MSPRIME_CCACHE=0; set CCACHE_DIR to share a cache between builds.
+    If MSPRIME_UNITY=1, the library sources are compiled as a single
+    translation unit. If MSPRIME_PGO=1, we do a profile guided
+    optimisation build with GCC. If MSPRIME_BUILD_CACHE=1, built
+    extensions are kept in ~/.cache/msprime (or the directory given by
+    MSPRIME_BUILD_CACHE_DIR) and reused by later builds of the same
+    sources with the same options. If MSPRIME_PCH=1, the headers used
+    by the library sources are precompiled once with GCC rather than
+    parsed for every source.
+    """
+    def finalize_options(self):
+        build_ext.finalize_options(self)
+        # Provide the library version as a compile time parameter to the
+        # extension module. setuptools_scm has already computed this for
+        # the distribution, so we don't run it again here.
+        version = self.distribution.get_version()
+        for ext in self.extensions:
+            ext.define_macros.append(
+                ("MSP_LIBRARY_VERSION_STR", '"{}"'.format(version)))
+
+    def run(self):
+        # We only look for the HDF5 and GSL paths when we're building, so
+        # that commands like egg_info and sdist don't run h5ls and
+        # pkg-config.
+        configurator = PathConfigurator()
+        self.library_versions = configurator.library_versions
+        for ext in self.extensions:
+            ext.include_dirs.extend(configurator.include_dirs)
+            ext.library_dirs.extend(configurator.library_dirs)
+        if os.environ.get("MSPRIME_PGO") == "1":
+            self.run_pgo()
+        else:
+            build_ext.run(self)
+
+    def run_pgo(self):
+        """
+        Builds the extension with profiling instrumentation, runs the
+        training simulations, and then rebuilds using the profile data.
+        """
+        profile_dir = os.path.abspath(os.path.join(self.build_temp, "pgo"))
+        if os.path.exists(profile_dir):
+            remove_tree(profile_dir, dry_run=self.dry_run)
+        # build_ext.run replaces the compiler name with the compiler
+        # instance, so we need to restore it for the second build.
+        compiler = self.compiler
+        # Every object must be rebuilt in both stages.
+        self.force = True
+        self.build_with_flags(["-fprofile-generate=" + profile_dir])
+        for ext in self.extensions:
+            ext_dir = os.path.dirname(
+                os.path.abspath(self.get_ext_fullpath(ext.name)))
+            log.info("running PGO training simulations")
+            subprocess.check_call(
+                [sys.executable, "-c", pgo_training_script], cwd=ext_dir)
+        self.compiler = compiler
+        self.build_with_flags([
+            "-fprofile-use=" + profile_dir, "-fprofile-correction"])
+
+    def build_with_flags(self, flags):
+        """
+        Runs the build with the specified flags added when compiling and
+        linking each of the extensions.
+        """
+        saved_args = [
+            (ext.extra_compile_args, ext.extra_link_args)
+            for ext in self.extensions]
+        for ext in self.extensions:
+            ext.extra_compile_args = ext.extra_compile_args + flags
+            ext.extra_link_args = ext.extra_link_args + flags
+        try:
+            build_ext.run(self)
+        finally:
+            for ext, (compile_args, link_args) in zip(
+                    self.extensions, saved_args):
+                ext.extra_compile_args = compile_args
+                ext.extra_link_args = link_args
+
+    def build_extensions(self):
+        if os.environ.get("MSPRIME_CCACHE") != "0":
+            self.use_ccache()
+        build_ext.build_extensions(self)
+
+    def use_ccache(self):
+        ccache = find_executable("ccache")
+        compiler_so = getattr(self.compiler, "compiler_so", None)
+        if ccache is None or compiler_so is None:
+            return
+        # Don't add ccache twice if it's already in CC.
+        if "ccache" not in os.path.basename(compiler_so[0]):
+            self.compiler.set_executable("compiler_so", [ccache] + compiler_so)
+
+    def write_unity_source(self, sources):
+        """
+        Writes a file to the build directory that includes each of the
+        specified sources, and returns its path. Compiling this file
+        means that the headers shared by the sources are parsed once
+        rather than once per source. The sources are included by their
+        paths relative to the source root, so that the file doesn't
+        depend on where the source tree is.
+        """
+        unity_source = os.path.join(self.build_temp, "_msprime_unity.c")
+        content = "".join(
+            '#include "{}"\n'.format(os.path.relpath(src).replace(os.sep, "/"))
+            for src in sources)
+        # Only write the file if it has changed, so that we don't
+        # needlessly recompile it.
+        if os.path.exists(unity_source):
+            with open(unity_source) as f:
+                if f.read() == content:
+                    return unity_source
+        self.mkpath(self.build_temp)
+        with open(unity_source, "w") as f:
+            f.write(content)
+        return unity_source
+
+    def write_pch_header(self):
+        """
+        Writes the header to be precompiled to the build directory, and
+        returns its path.
+        """
+        pch_header = os.path.join(self.build_temp, "msprime_pch.h")
+        content = "".join(
+            "#include {}\n".format(header) for header in pch_includes)
+        if os.path.exists(pch_header):
+            with open(pch_header) as f:
+                if f.read() == content:
+                    return pch_header
+        self.mkpath(self.build_temp)
+        with open(pch_header, "w") as f:
+            f.write(content)
+        return pch_header
+
+    def get_unity_extension(self, ext):
+        """
+        Returns a copy of the specified extension in which the library
+        sources are replaced by the unity source. We don't change the
+        original, as PGO builds call build_extension on it twice.
+        """
+        lib_sources = [src for src in ext.sources if src.startswith(d)]
+        unity_ext = copy.copy(ext)
+        unity_ext.sources = [
+            src for src in ext.sources if src not in lib_sources]
+        unity_ext.sources.append(self.write_unity_source(lib_sources))
+        # The unity source includes the library sources relative to the
+        # source root, which is the current directory when building.
+        unity_ext.include_dirs = [os.curdir] + ext.include_dirs
+        # Make sure we still rebuild when the library sources change.
+        unity_ext.depends = ext.depends + lib_sources
+        return unity_ext
+
+    def build_extension(self, ext):
+        if os.environ.get("MSPRIME_UNITY") == "1":
+            ext = self.get_unity_extension(ext)
+        # distutils itself only uses the parallel option to build
+        # different extensions at the same time, which doesn't help us
+        # as we only have one.
+        num_jobs = getattr(self, "parallel", None)
+        if num_jobs is True or (not num_jobs and parallel_build):
+            num_jobs = get_num_build_jobs()
+        # We compile with compile_sources even when we're not running jobs
+        # in parallel, so that editing one file (usually _msprimemodule.c)
+        # only recompiles that file before relinking.
+        compile_options = {}
+        if os.environ.get("MSPRIME_PCH") == "1":
+            compile_options["pch_header"] = self.write_pch_header()
+            compile_options["pch_sources"] = [
+                src for src in ext.sources if src.startswith(d)]
+        if uses_generic_compile(self.compiler):
+            self.compiler.compile = functools.partial(
+                compile_sources, self.compiler, int(num_jobs or 1),
+                **compile_options)
+        # The profile data for PGO builds isn't part of the cache key.
+        if (os.environ.get("MSPRIME_BUILD_CACHE") == "1" and
+                os.environ.get("MSPRIME_PGO") != "1"):
+            self.build_extension_cached(ext)
+        else:
+            build_ext.build_extension(self, ext)
+
+    def get_build_cache_key(self, ext):
+        """
+        Returns a hash of everything that goes into building the specified
+        extension: the sources and the local headers they include, the
+        compile and link options, the compiler, the Python interpreter,
+        and the versions of GSL and HDF5 that we compile and link against.
+        """
+        h = hashlib.sha256()
+        headers = set()
+        for src in ext.sources:
+            find_local_headers(src, ext.include_dirs, headers)
+        paths = list(ext.sources) + sorted(set(ext.depends) | headers)
+        # The library version headers are outside the source tree, so
+        # find_local_headers doesn't see them. CFLAGS may also add -I
+        # options to the compiler command.
+        compiler_so = getattr(self.compiler, "compiler_so", None) or []
+        include_dirs = list(ext.include_dirs) + list(self.include_dirs) + [
+            arg[2:] for arg in compiler_so if arg.startswith("-I")]
+        paths += find_library_version_headers(include_dirs)
+        for path in paths:
+            with open(path, "rb") as f:
+                h.update(path.encode())
+                h.update(f.read())
+        config = [
+            ext.define_macros, ext.undef_macros, ext.extra_compile_args,
+            ext.extra_link_args, ext.include_dirs, ext.library_dirs,
+            ext.libraries, self.debug,
+            getattr(self.compiler, "compiler_so", None),
+            getattr(self.compiler, "linker_so", None),
+            self.get_ext_filename(ext.name), sys.version, platform.machine(),
+            getattr(self, "library_versions", None)]
+        h.update(repr(config).encode())
+        return h.hexdigest()
+
+    def build_extension_cached(self, ext):
+        """
+        Copies the specified extension from the build cache if we have
+        already built it, and otherwise builds it and adds it to the cache.
+        """
+        cache_dir = os.environ.get(
+            "MSPRIME_BUILD_CACHE_DIR",
+            os.path.join(os.path.expanduser("~"), ".cache", "msprime"))
+        ext_path = self.get_ext_fullpath(ext.name)
+        cached_path = os.path.join(cache_dir, "{}-{}{}".format(
+            ext.name, self.get_build_cache_key(ext),
+            os.path.splitext(ext_path)[1]))
+        if os.path.exists(cached_path) and not self.force:
+            log.info("copying %s from the build cache", ext.name)
+            self.mkpath(os.path.dirname(ext_path))
+            self.copy_file(cached_path, ext_path)
+            return
+        # An existing extension may have been built from other sources, or
+        # copied from the cache with an older timestamp, so we must not let
+        # build_ext decide it is up to date. The same goes for the objects,
+        # which may have been compiled with other options; we don't want
+        # to store anything but a clean build under this key.
+        if os.path.exists(ext_path) and not self.dry_run:
+            os.remove(ext_path)
+        force = self.compiler.force
+        self.compiler.force = True
+        try:
+            build_ext.build_extension(self, ext)
+        finally:
+            self.compiler.force = force
+        if not self.dry_run:
+            self.mkpath(cache_dir)
+            # Copy to a temporary file first so that other builds never
+            # see a partly written extension.
+            tmp_path = "{}.{}.tmp".format(cached_path, os.getpid())
+            shutil.copyfile(ext_path, tmp_path)
+            os.rename(tmp_path, cached_path)
+
+
+def parallel_compile(self, sources, *args, **kwargs):
+    """
+    Replacement for CCompiler.compile that uses get_num_build_jobs()
+    compiler processes.
+    """
+    return compile_sources(
+        self, get_num_build_jobs(), sources, *args, **kwargs)
+
+
+# Where build_ext has no parallel option (e.g. on Python 2) we can still
+# compile in parallel by patching CCompiler itself. This affects every
+# extension built by this process, so it is opt-in.
+parallel_build = os.environ.get("MSPRIME_PARALLEL_BUILD") == "1"
+if parallel_build:
+    CCompiler.compile = parallel_compile
+
+build_ext_options = {}
+# The parallel option is not available in Python 2.
+if any(option[0] == "parallel=" for option in build_ext.user_options):
+    build_ext_options["parallel"] = get_num_build_jobs()
 
 
 class PathConfigurator(object):
@@ -40,6 +540,9 @@ class PathConfigurator(object):
         # TODO: make some other guesses for this...
         self.include_dirs = []
         self.library_dirs = []
+        # The versions reported by h5ls and pkg-config; these are part
+        # of the build cache key.
+        self.library_versions = []
         self._check_hdf5_version()
         self._attempt_pkgconfig()
 
@@ -47,6 +550,7 @@ class PathConfigurator(object):
         try:
             output = subprocess.check_output(["h5ls", "-V"]).split()
             version_str = output[2]
+            self.library_versions.append(version_str.decode())
             version = list(map(int, version_str.split(b".")[:2]))
             if version < [1, 8]:
                 # TODO is there a better exception to raise here?
@@ -64,8 +568,7 @@ class PathConfigurator(object):
         packages = ["gsl", "hdf5"]
         cmd = [pkgconfig] + cmd + packages
         output = subprocess.check_output(cmd).split()
-        # Strip off the leading -I or -L
-        return [arg[2:].decode() for arg in output]
+        return [arg.decode() for arg in output]
 
     def _get_pkgconfig_list(self, option):
         ret = []
@@ -78,32 +581,48 @@ class PathConfigurator(object):
         return ret
 
     def _attempt_pkgconfig(self):
-        self.library_dirs = self._get_pkgconfig_list("--libs-only-L")
-        self.include_dirs = self._get_pkgconfig_list("--cflags-only-I")
+        # Strip off the leading -I or -L
+        self.library_dirs = [
+            arg[2:] for arg in self._get_pkgconfig_list("--libs-only-L")]
+        self.include_dirs = [
+            arg[2:] for arg in self._get_pkgconfig_list("--cflags-only-I")]
+        self.library_versions.extend(
+            self._get_pkgconfig_list("--modversion"))
 
 
-# Now, setup the extension module. We have to do some quirky workarounds
-# here so that we can get the current version number from setuptools_scm
-# and also get this version provided as a compile time parameter to the
-# extension module.
-class DefineMacros(object):
-    def __init__(self):
-        self._msprime_version = None
-
-    def __getitem__(self, index):
-        if self._msprime_version is None:
-            import setuptools_scm
-            self._msprime_version = setuptools_scm.get_version()
-        l = [
-            # We define this macro to ensure we're using the v18 versions of
-            # the HDF5 API and not earlier deprecated versions.
-            ("H5_NO_DEPRECATED_SYMBOLS", None),
-            # Define the library version
-            ("MSP_LIBRARY_VERSION_STR", '"{}"'.format(self._msprime_version)),
-        ]
-        return l[index]
+# Asserts in the C library are disabled unless MSPRIME_DEBUG is set.
+debug_build = bool(os.environ.get("MSPRIME_DEBUG"))
+extra_compile_args = []
+extra_link_args = []
+if sys.platform.startswith("linux") or sys.platform == "darwin":
+    # Only export the module init function, and put each function and
+    # variable in its own section so that the linker can drop the library
+    # code that the module doesn't use.
+    extra_compile_args.extend([
+        "-fvisibility=hidden", "-ffunction-sections", "-fdata-sections"])
+    if sys.platform == "darwin":
+        extra_link_args.append("-Wl,-dead_strip")
+    else:
+        extra_link_args.append("-Wl,--gc-sections")
+if os.environ.get("MSPRIME_NATIVE") == "1":
+    # Optimise for the build machine; the result may not run elsewhere.
+    extra_compile_args.append("-march=native")
+# Extra optimisation flags for the C library, such as
+# MSPRIME_CFLAGS="-O3 -flto -funroll-loops". LTO flags must also be
+# given when linking.
+optimisation_flags = os.environ.get("MSPRIME_CFLAGS", "").split()
+extra_compile_args.extend(optimisation_flags)
+extra_link_args.extend(
+    flag for flag in optimisation_flags if flag.startswith("-flto"))
+
+define_macros = [
+    # We define this macro to ensure we're using the v18 versions of
+    # the HDF5 API and not earlier deprecated versions.
+    ("H5_NO_DEPRECATED_SYMBOLS", None),
+]
+if not debug_build:
+    define_macros.append(("NDEBUG", None))
 
-configurator = PathConfigurator()
 d = "lib/"
 _msprime_module = Extension(
     '_msprime',
@@ -112,12 +631,15 @@ _msprime_module = Extension(
         d + "tree_sequence.c", d + "object_heap.c", d + "newick.c",
         d + "hapgen.c", d + "recomb_map.c", d + "mutgen.c",
         d + "vargen.c", d + "vcf.c", d + "ld.c"],
-    # Enable asserts by default.
-    undef_macros=["NDEBUG"],
-    define_macros=DefineMacros(),
+    # Without this, build_ext thinks the extension is up to date when
+    # only the headers have changed.
+    depends=sorted(glob.glob(d + "*.h")),
+    undef_macros=["NDEBUG"] if debug_build else [],
+    define_macros=define_macros,
+    extra_compile_args=extra_compile_args,
+    extra_link_args=extra_link_args,
     libraries=["gsl", "gslcblas", "hdf5"],
-    include_dirs=[d] + configurator.include_dirs,
-    library_dirs=configurator.library_dirs,
+    include_dirs=[d],
 )
 
 with open("README.txt") as f:
@@ -134,11 +656,15 @@ setup(
     entry_points={
         'console_scripts': [
             'mspms=msprime.cli:mspms_main',
+            'mspms-client=msprime.cli:mspms_client_main',
             'msp=msprime.cli:msp_main',
         ]
     },
     install_requires=["svgwrite"],
+    python_requires=">=2.7, !=3.0.*, !=3.1.*",
     ext_modules=[_msprime_module],
+    cmdclass={"build_ext": BuildExt},
+    options={"build_ext": build_ext_options},
     keywords=["Coalescent simulation", "ms"],
     license="GNU LGPLv3+",
     platforms=["POSIX"],
@@ -148,7 +674,6 @@ setup(
         "Programming Language :: Python :: 2",
         "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.1",
         "Programming Language :: Python :: 3.2",
         "Programming Language :: Python :: 3.3",
         "Development Status :: 4 - Beta",
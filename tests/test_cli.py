@@ -28,6 +28,7 @@ import os
 import random
 import sys
 import tempfile
+import threading
 import unittest
 
 import msprime
@@ -112,6 +113,9 @@ class TestRandomSeeds(unittest.TestCase):
         for _ in range(num_random_tests):
             s = tuple(cli.generate_seeds())
             self.assertEqual(len(set(s)), 3)
+            for seed in s:
+                self.assertGreater(seed, 0)
+                self.assertLess(seed, 2**31)
             self.assertNotIn(s, seeds)
             seeds.add(s)
         self.assertEqual(len(seeds), num_random_tests)
@@ -235,6 +239,14 @@ class TestMspmsArgumentParser(unittest.TestCase):
         args = self.parse_args(["40", "20", "--trees"])
         self.assertEqual(args.trees, True)
 
+    def test_num_threads(self):
+        args = self.parse_args(["40", "20"])
+        self.assertEqual(args.num_threads, 1)
+        args = self.parse_args(["40", "20", "-P", "4"])
+        self.assertEqual(args.num_threads, 4)
+        args = self.parse_args(["40", "20", "--num-threads", "2"])
+        self.assertEqual(args.num_threads, 2)
+
     def test_size_changes(self):
         args = self.parse_args(["40", "20"])
         self.assertEqual(args.size_change, [])
@@ -902,7 +914,7 @@ class TestMspmsOutput(unittest.TestCase):
     def verify_output(
             self, sample_size=2, num_loci=1, recombination_rate=0,
             num_replicates=1, mutation_rate=0.0, print_trees=True,
-            precision=3, random_seeds=[1, 2, 3]):
+            precision=3, random_seeds=[1, 2, 3], num_threads=1):
         """
         Runs the UI for the specified parameters, and parses the output
         to ensure it's consistent.
@@ -915,7 +927,7 @@ class TestMspmsOutput(unittest.TestCase):
             scaled_recombination_rate=recombination_rate,
             num_replicates=num_replicates, scaled_mutation_rate=mutation_rate,
             print_trees=print_trees, precision=precision,
-            random_seeds=random_seeds)
+            random_seeds=random_seeds, num_threads=num_threads)
         with tempfile.TemporaryFile("w+") as f:
             sr.run(f)
             f.seek(0)
@@ -1040,6 +1052,16 @@ class TestMspmsOutput(unittest.TestCase):
         self.verify_output(random_seeds=None)
         self.verify_output(random_seeds=[2, 3, 4])
 
+    def test_num_threads(self):
+        for num_threads in [2, 3]:
+            self.verify_output(
+                sample_size=10, mutation_rate=10, num_replicates=5,
+                num_threads=num_threads)
+            self.verify_output(
+                sample_size=10, mutation_rate=10, num_loci=10,
+                recombination_rate=10, num_replicates=5,
+                num_threads=num_threads)
+
     def test_correct_streams(self):
         args = "15 1 -r 0 1.0 -eG 1.0 5.25 -eG 2.0 10 -G 4 -eN 3.0 1.0 -T"
         stdout, stderr = capture_output(cli.mspms_main, args.split())
@@ -1070,6 +1092,146 @@ class TestMspmsOutput(unittest.TestCase):
             output2 = f.read()
         self.assertEqual(output1, output2)
 
+    def test_parallel_seed_equivalence(self):
+        outputs = []
+        for num_threads in [2, 3, 5]:
+            sr = cli.SimulationRunner(
+                sample_size=10, scaled_mutation_rate=10, num_loci=10,
+                scaled_recombination_rate=10, num_replicates=10,
+                print_trees=True, random_seeds=[1, 2, 3],
+                num_threads=num_threads)
+            with tempfile.TemporaryFile("w+") as f:
+                sr.run(f)
+                f.seek(0)
+                outputs.append(f.read())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
+
+@unittest.skipIf(
+    not hasattr(cli.socketserver, "UnixStreamServer"),
+    "Unix domain sockets not supported")
+class TestMspmsDaemon(unittest.TestCase):
+    """
+    Tests for running mspms command lines through the daemon.
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="msp_cli_testcase_")
+        self.socket_path = os.path.join(self.temp_dir, "mspms.sock")
+        self.server = cli.create_mspms_daemon(self.socket_path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        os.unlink(self.socket_path)
+        os.rmdir(self.temp_dir)
+
+    def get_buffer(self):
+        if sys.version_info[0] == 2:
+            return io.BytesIO()
+        return io.StringIO()
+
+    def run_client(self, arg_list):
+        output = self.get_buffer()
+        errors = self.get_buffer()
+        status = cli.run_mspms_client(
+            self.socket_path, ["mspms"] + arg_list, arg_list, output, errors)
+        return status, output.getvalue(), errors.getvalue()
+
+    def verify_output(self, cmd):
+        arg_list = cmd.split()
+        status, output, errors = self.run_client(arg_list)
+        self.assertEqual(status, 0)
+        self.assertEqual(errors, "")
+        direct = self.get_buffer()
+        cli.get_mspms_runner(arg_list).run(
+            direct, command_line=["mspms"] + arg_list)
+        self.assertEqual(output, direct.getvalue())
+        self.assertEqual(output.splitlines()[0], "mspms " + cmd)
+
+    def test_trees(self):
+        self.verify_output("5 3 -T -seeds 1 2 3")
+        self.verify_output("5 3 -T -r 10 100 -seeds 1 2 3")
+
+    def test_mutations(self):
+        self.verify_output("5 3 -t 10 -seeds 1 2 3")
+
+    def test_repeated_requests(self):
+        for j in range(10):
+            self.verify_output("4 2 -T -t 1 -seeds 1 2 {}".format(j + 1))
+
+    def test_errors(self):
+        for cmd in ["", "10", "10 -1", "10 1 -T -t x"]:
+            status, output, errors = self.run_client(cmd.split())
+            self.assertEqual(status, 2)
+            self.assertEqual(output, "")
+            self.assertGreater(len(errors), 0)
+        # The daemon is still usable after errors.
+        self.verify_output("5 3 -T -seeds 1 2 3")
+
+    def test_simulation_error(self):
+        # Without migration between the populations, the simulation can
+        # never finish.
+        status, output, errors = self.run_client("10 1 -T -I 2 5 5".split())
+        self.assertEqual(status, 1)
+        self.assertEqual(output, "")
+        self.assertIn("LibraryError", errors)
+        # The daemon is still usable after errors.
+        self.verify_output("5 3 -T -seeds 1 2 3")
+
+    def test_help(self):
+        status, output, errors = self.run_client(["-h"])
+        self.assertEqual(status, 0)
+        self.assertGreater(len(output), 0)
+        self.assertEqual(errors, "")
+
+    def test_daemon_flag_position(self):
+        for arg_list in [["--daemon", "-h"], ["-h", "--daemon"]]:
+            stdout = sys.stdout
+            sys.stdout = self.get_buffer()
+            try:
+                with self.assertRaises(SystemExit) as cm:
+                    cli.mspms_main(arg_list)
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            self.assertEqual(cm.exception.code, 0)
+            self.assertTrue(output.startswith("usage: mspms --daemon"))
+
+    def test_mspms_help_mentions_daemon(self):
+        help_text = cli.get_mspms_parser().format_help()
+        self.assertIn("mspms --daemon", help_text)
+
+    def test_client_main(self):
+        cmd = "5 3 -T -t 2 -seeds 1 2 3"
+        arg_list = ["--socket", self.socket_path] + cmd.split()
+        stdout, stderr = capture_output(cli.mspms_client_main, arg_list)
+        self.assertEqual(stderr, "")
+        lines = stdout.splitlines()
+        self.assertEqual(lines[0], "mspms " + cmd)
+        direct, stderr = capture_output(cli.mspms_main, cmd.split())
+        self.assertEqual(lines[1:], direct.splitlines()[1:])
+
+    def test_client_main_errors(self):
+        with self.assertRaises(SystemExit) as cm:
+            capture_output(
+                cli.mspms_client_main, ["--socket", self.socket_path, "10"])
+        self.assertEqual(cm.exception.code, 2)
+
+    def test_client_parser(self):
+        parser = cli.get_mspms_client_parser()
+        args = parser.parse_args(["--socket", "x", "10", "2", "-T", "-h"])
+        self.assertEqual(args.socket, "x")
+        self.assertEqual(args.mspms_args, ["10", "2", "-T", "-h"])
+
+    def test_daemon_parser(self):
+        parser = cli.get_mspms_daemon_parser()
+        args = parser.parse_args(["-s", "x"])
+        self.assertEqual(args.socket, "x")
+
 
 class TestMspArgumentParser(unittest.TestCase):
     """